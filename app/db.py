@@ -110,8 +110,8 @@ class Database:
             comment_text: Текст комментария
             next_send_at: Время следующей отправки
         """
-        # Проверяем, есть ли уже запись
-        existing = self.client.table("pending_notifications").select("*").eq("task_id", task_id).eq("user_id", user_id).execute()
+        # Проверяем, есть ли уже запись (нужен только факт наличия, тексты комментариев не тянем)
+        existing = self.client.table("pending_notifications").select("task_id").eq("task_id", task_id).eq("user_id", user_id).execute()
         
         if existing.data:
             # Обновляем существующую запись
@@ -272,8 +272,10 @@ class Database:
         """
         from .utils import schedule_after
         
-        # Получаем текущую запись
-        result = self.client.table("pending_notifications").select("*").eq("task_id", task_id).eq("user_id", user_id).execute()
+        # Получаем текущую запись (только поля, нужные для TTL и переноса)
+        result = self.client.table("pending_notifications").select(
+            "last_mention_at, times_sent"
+        ).eq("task_id", task_id).eq("user_id", user_id).execute()
         
         if not result.data:
             return
@@ -5,10 +5,21 @@ import hmac
 import hashlib
 import re
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Optional
 import pytz
 
 
+# Всё, кроме цифр и '+', вырезается из телефона при нормализации
+PHONE_JUNK_RE = re.compile(r'[^\d+]')
+
+
+@lru_cache(maxsize=None)
+def get_timezone(tz_name: str):
+    """Объект таймзоны pytz по имени (кэшируется: имена таймзон в приложении из конфигурации)"""
+    return pytz.timezone(tz_name)
+
+
 def verify_pyrus_signature(raw_body: bytes, secret: str, dev_skip: bool = False, signature_header: str = "") -> bool:
     """
     Проверка подписи HMAC-SHA1 от Pyrus
@@ -61,7 +72,7 @@ def normalize_phone_e164(phone: str) -> Optional[str]:
         return None
     
     # Удаляем всё кроме цифр и +
-    clean_phone = re.sub(r'[^\d+]', '', phone)
+    clean_phone = PHONE_JUNK_RE.sub('', phone)
     
     # Если начинается с 8, заменяем на +7 (Россия)
     if clean_phone.startswith('8'):
@@ -100,7 +111,7 @@ def is_in_quiet_hours(
     Returns:
         True если время в тихих часах
     """
-    tz = pytz.timezone(tz_name)
+    tz = get_timezone(tz_name)
     
     # Конвертируем в нужную таймзону
     if dt.tzinfo is None:
@@ -145,7 +156,7 @@ def schedule_after(
     Returns:
         Время отправки с учётом тихих часов (в UTC без timezone)
     """
-    tz = pytz.timezone(tz_name)
+    tz = get_timezone(tz_name)
     
     # Обеспечиваем что base_ts имеет таймзону
     if base_ts.tzinfo is None:
@@ -4,12 +4,49 @@
 Интерактивный помощник для запуска различных видов диагностики
 """
 import os
+import re
 import sys
+import asyncio
 import subprocess
 import argparse
 from datetime import datetime
+from importlib.metadata import distributions
+from importlib.util import find_spec
 from pathlib import Path
 
+# Подробный вывод по каждому пункту - только в терминале или с флагом --verbose (выставляется в main)
+VERBOSE = sys.stdout.isatty()
+
+# Строка requirements.txt: имя пакета, необязательные extras, спецификатор версии, маркеры и комментарий.
+# Вторая группа - только точная версия (==), для остальных спецификаторов (>=, ~=, <...) она None
+REQUIREMENT_RE = re.compile(
+    r'^\s*([A-Za-z0-9_.\-]+)\s*(?:\[[^\]]*\])?\s*(?:==\s*([^\s;#,]+)(?:\s*,[^;#]*)?|[<>!~=][^;#]*)?\s*(?:;[^#]*)?(?:#.*)?$'
+)
+
+def get_diag_concurrency():
+    """Сколько проверок-подпроцессов запускать одновременно.
+    
+    Переопределяется через DIAG_CONCURRENCY; при некорректном значении - значение по умолчанию
+    """
+    default = min(32, (os.cpu_count() or 1) + 4)
+    value = os.getenv("DIAG_CONCURRENCY", "").strip()
+    if not value:
+        return default
+    try:
+        return max(1, int(value))
+    except ValueError:
+        print(f"⚠️ Некорректное DIAG_CONCURRENCY={value!r}, используется {default}")
+        return default
+
+def normalize_dist_name(name):
+    """Нормализованное имя дистрибутива (PEP 503): регистр и разделители -_. не важны"""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+def vprint(msg):
+    """Печать подробностей только в режиме VERBOSE"""
+    if VERBOSE:
+        print(msg)
+
 def run_command(cmd):
     """Запуск команды с выводом результата"""
     print(f"🚀 Выполняется: {' '.join(cmd)}")
@@ -18,6 +55,32 @@ def run_command(cmd):
     print("-" * 50)
     return result.returncode == 0
 
+async def run_command_async(cmd, timeout=30):
+    """Запуск команды без блокировки event loop, возвращает (код возврата, stdout, stderr)"""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return -1, "", f"превышен таймаут {timeout} сек"
+    return proc.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+def find_diagnostic_reports():
+    """JSON отчеты диагностики в текущей директории: пары (путь, mtime), от новых к старым.
+    
+    Каталог читается один раз, stat() делается один раз на файл (кэшируется в DirEntry)
+    """
+    with os.scandir(".") as it:
+        reports = [
+            (Path(entry.name), entry.stat().st_mtime) for entry in it
+            if entry.name.startswith("diagnostic_report_") and entry.name.endswith(".json")
+        ]
+    reports.sort(key=lambda item: item[1], reverse=True)
+    return reports
+
 def interactive_menu():
     """Интерактивное меню диагностики"""
     print("""
@@ -72,9 +135,9 @@ def full_diagnostics():
     
     if success:
         # Находим последний созданный отчет
-        reports = list(Path(".").glob("diagnostic_report_*.json"))
+        reports = find_diagnostic_reports()
         if reports:
-            latest_report = max(reports, key=lambda p: p.stat().st_mtime)
+            latest_report = reports[0][0]
             print(f"\n📄 Отчет сохранен: {latest_report}")
             print("💡 Для сравнения с другой машиной используйте опцию 3")
     
@@ -86,7 +149,7 @@ def compare_diagnostics():
     print("=" * 50)
     
     # Ищем JSON отчеты
-    reports = list(Path(".").glob("diagnostic_report_*.json"))
+    reports = find_diagnostic_reports()
     
     if len(reports) < 1:
         print("❌ Не найдено ни одного отчета диагностики!")
@@ -95,7 +158,7 @@ def compare_diagnostics():
     
     if len(reports) == 1:
         print("📄 Найден один отчет диагностики:")
-        print(f"   {reports[0]}")
+        print(f"   {reports[0][0]}")
         print("\n❓ Для сравнения нужны отчеты с двух машин.")
         print("💡 Инструкция:")
         print("   1. Скопируйте этот отчет на другую машину")
@@ -104,18 +167,15 @@ def compare_diagnostics():
         
         return True
     
-    # Если есть несколько отчетов, выбираем два последних
-    reports.sort(key=lambda p: p.stat().st_mtime, reverse=True)
-    
+    # Если есть несколько отчетов, выбираем два последних (список уже отсортирован по mtime)
     print("📄 Найдено отчетов диагностики:")
-    for i, report in enumerate(reports[:5], 1):
-        mtime = datetime.fromtimestamp(report.stat().st_mtime)
-        print(f"   {i}. {report} ({mtime.strftime('%Y-%m-%d %H:%M:%S')})")
+    for i, (report, mtime) in enumerate(reports[:5], 1):
+        print(f"   {i}. {report} ({datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')})")
     
     if len(reports) >= 2:
         print(f"\n🔄 Сравниваем два последних отчета:")
-        print(f"   Отчет 1: {reports[1]}")
-        print(f"   Отчет 2: {reports[0]}")
+        print(f"   Отчет 1: {reports[1][0]}")
+        print(f"   Отчет 2: {reports[0][0]}")
         
         python_cmd = get_python_command()
         if not python_cmd:
@@ -123,7 +183,7 @@ def compare_diagnostics():
         
         return run_command([
             python_cmd, "compare_diagnostics.py",
-            str(reports[1]), str(reports[0]),
+            str(reports[1][0]), str(reports[0][0]),
             "--name1", "Более старый",
             "--name2", "Более новый"
         ])
@@ -202,12 +262,43 @@ def check_imports():
     
     failed = []
     
+    # Модули проекта реально импортируем, чтобы увидеть ошибки импорта,
+    # но в отдельных процессах (не засоряя текущий интерпретатор) и одновременно.
+    # Уже загруженные в этот процесс модули заведомо импортируются - их не проверяем
+    project_modules = [
+        module for module in modules
+        if module.startswith("app.") and module not in sys.modules
+    ]
+    
+    concurrency = get_diag_concurrency()
+    
+    async def probe_project_modules():
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def probe(module):
+            async with semaphore:
+                return await run_command_async([sys.executable, "-c", f"import {module}"])
+        
+        return await asyncio.gather(*(probe(module) for module in project_modules))
+    
+    project_results = dict(zip(project_modules, asyncio.run(probe_project_modules())))
+    
     for module in modules:
-        try:
-            __import__(module.replace("-", "_"))
+        if module in sys.modules:
+            ok = True
+        elif module in project_results:
+            returncode, _, stderr = project_results[module]
+            ok = returncode == 0
+            error = stderr.strip().splitlines()[-1] if stderr.strip() else ""
+        else:
+            # Для внешних пакетов достаточно проверить наличие без выполнения кода модуля
+            ok = find_spec(module.replace("-", "_")) is not None
+            error = "модуль не найден"
+        
+        if ok:
             print(f"✅ {module}")
-        except ImportError as e:
-            print(f"❌ {module}: {e}")
+        else:
+            print(f"❌ {module}: {error}")
             failed.append(module)
     
     if failed:
@@ -230,15 +321,15 @@ def check_environment():
         "PYRUS_LOGIN", "PYRUS_SECURITY_KEY"
     ]
     
-    missing = []
-    
+    # Один снимок окружения (уже с учетом .env) и один проход по списку
+    env = dict(os.environ)
+    present, missing = [], []
     for var in required_vars:
-        value = os.getenv(var)
-        if value:
-            print(f"✅ {var}: установлена ({len(value)} символов)")
-        else:
-            print(f"❌ {var}: НЕ УСТАНОВЛЕНА")
-            missing.append(var)
+        (present if env.get(var) else missing).append(var)
+    
+    print(f"{'✅' if not missing else '❌'} Переменные окружения: установлено {len(present)} из {len(required_vars)}")
+    for var in present:
+        vprint(f"✅ {var}: установлена")
     
     if missing:
         print(f"\n🔧 Добавьте в .env файл:")
@@ -249,8 +340,6 @@ def check_environment():
 
 def check_apis():
     """Проверка API подключений"""
-    import asyncio
-    
     async def test_apis():
         try:
             import httpx
@@ -265,16 +354,22 @@ def check_apis():
             if supabase_url:
                 apis.append(("Supabase", f"{supabase_url}/rest/v1/"))
             
-            async with httpx.AsyncClient(timeout=10) as client:
-                for name, url in apis:
-                    try:
-                        response = await client.get(url)
-                        if response.status_code < 400:
-                            print(f"✅ {name}: доступен")
-                        else:
-                            print(f"❌ {name}: HTTP {response.status_code}")
-                    except Exception as e:
-                        print(f"❌ {name}: {e}")
+            async def probe(client, name, url):
+                try:
+                    response = await client.get(url)
+                    if response.status_code < 400:
+                        return f"✅ {name}: доступен"
+                    return f"❌ {name}: HTTP {response.status_code}"
+                except Exception as e:
+                    return f"❌ {name}: {e}"
+            
+            # Запросы идут одновременно через общий клиент: зависший API не задерживает остальные,
+            # результаты печатаем в исходном порядке
+            limits = httpx.Limits(max_connections=max(len(apis), 1))
+            async with httpx.AsyncClient(timeout=10, limits=limits) as client:
+                results = await asyncio.gather(*(probe(client, name, url) for name, url in apis))
+            for line in results:
+                print(line)
         
         except ImportError:
             print("❌ httpx не установлен")
@@ -291,16 +386,27 @@ def check_packages():
     """Проверка пакетов"""
     try:
         with open("requirements.txt", "r") as f:
-            required = [line.strip().split("==")[0] for line in f if line.strip() and not line.startswith("#")]
+            required = [m.groups() for m in map(REQUIREMENT_RE.match, f) if m]
+        
+        # Один проход по установленным дистрибутивам вместо поиска каждого пакета по sys.path;
+        # сверяем имена дистрибутивов, а не модулей (python-dotenv -> dotenv и т.п.).
+        # При дублях на sys.path оставляем первый - именно его подхватит импорт
+        installed = {}
+        for dist in distributions():
+            name = dist.name
+            if name:
+                installed.setdefault(normalize_dist_name(name), dist.version)
         
         missing = []
-        for package in required:
-            try:
-                __import__(package.replace("-", "_"))
-                print(f"✅ {package}")
-            except ImportError:
+        for package, required_version in required:
+            version = installed.get(normalize_dist_name(package))
+            if version is None:
                 print(f"❌ {package}: не установлен")
                 missing.append(package)
+            elif required_version and version != required_version:
+                print(f"⚠️ {package}: {version} (в requirements.txt {required_version})")
+            else:
+                print(f"✅ {package}")
         
         if missing:
             print(f"\n🔧 Установите: pip install {' '.join(missing)}")
@@ -318,12 +424,13 @@ def check_permissions():
     ]
     
     issues = []
+    # Одно чтение корня проекта вместо отдельного stat() на каждый путь
+    root_entries = {entry.name for entry in os.scandir(".")}
     
     for file_path in files_to_check:
-        path = Path(file_path)
-        if path.exists():
-            readable = os.access(path, os.R_OK)
-            writable = os.access(path, os.W_OK)
+        if file_path.rstrip("/") in root_entries:
+            readable = os.access(file_path, os.R_OK)
+            writable = os.access(file_path, os.W_OK)
             
             status = "✅" if readable and writable else "❌"
             perms = f"{'r' if readable else '-'}{'w' if writable else '-'}"
@@ -340,14 +447,9 @@ def check_permissions():
     return len(issues) == 0
 
 def get_python_command():
-    """Определяет команду для запуска Python"""
-    for cmd in ["python3", "python"]:
-        try:
-            result = subprocess.run([cmd, "--version"], capture_output=True, text=True)
-            if result.returncode == 0:
-                return cmd
-        except FileNotFoundError:
-            continue
+    """Определяет команду для запуска Python: тот же интерпретатор, что выполняет диагностику"""
+    if sys.executable:
+        return sys.executable
     
     print("❌ Python не найден! Установите Python 3.7+")
     return None
@@ -356,7 +458,8 @@ def check_prerequisites():
     """Проверка предварительных условий"""
     # Проверяем, что мы в правильной директории
     required_files = ["app/", "requirements.txt"]
-    missing = [f for f in required_files if not Path(f).exists()]
+    root_entries = {entry.name for entry in os.scandir(".")}
+    missing = [f for f in required_files if f.rstrip("/") not in root_entries]
     
     if missing:
         print(f"❌ Вы не в директории проекта PyrusTelegramBot!")
@@ -376,16 +479,20 @@ def main():
     parser.add_argument("--full", action="store_true", help="Полная диагностика") 
     parser.add_argument("--compare", action="store_true", help="Сравнение отчетов")
     parser.add_argument("--help-docs", action="store_true", help="Показать инструкции")
+    parser.add_argument("--verbose", action="store_true", help="Подробный вывод проверок")
     
     args = parser.parse_args()
     
+    global VERBOSE
+    VERBOSE = VERBOSE or args.verbose
+    
     # Проверяем предварительные условия
     if not check_prerequisites():
         sys.exit(1)
     
     print("🔍 ДИАГНОСТИКА PyrusTelegramBot")
     print("=" * 50)
-    print(f"📁 Директория: {Path.cwd()}")
+    print(f"📁 Директория: {os.getcwd()}")
     print(f"🕐 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("=" * 50)
     
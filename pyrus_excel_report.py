@@ -15,18 +15,30 @@
 import asyncio
 import sys
 import os
+import heapq
 import json
+from bisect import bisect_right
 from pathlib import Path
-from typing import Dict, List, Any, Optional, Tuple, Set
+from typing import Dict, List, Any, Optional, Tuple
 from datetime import datetime
 from collections import defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
+from operator import attrgetter
 
+import numpy as np
 import pandas as pd
 from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Alignment
+from openpyxl.utils import get_column_letter
 from openpyxl.utils.dataframe import dataframe_to_rows
 from dotenv import load_dotenv
 
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson не установлен - используем стандартный json
+    from json import loads as json_loads
+
 # Загружаем переменные окружения из .env файла
 load_dotenv()
 
@@ -35,6 +47,40 @@ sys.path.append(str(Path(__file__).parent / "app"))
 
 from pyrus_client import PyrusClient
 
+# Филиалы, объединяемые под общим названием: (подстроки, которые все должны входить в название) -> итог
+BRANCH_ALIASES = (
+    (("коммунистический", "22"), "Копейск"),
+    (("славы", "30"), "Копейск"),
+)
+
+# Подписи призов преподавателей для Excel
+PRIZE_LABELS = {
+    "iPad": "📱 iPad",
+    "HonorPad": "📲 HonorPad",
+    "Подписка в Tg Premium": "💎 Подписка в Tg Premium"
+}
+
+# Границы групп преподавателей: bisect_right(bounds, count) дает номер группы,
+# имя группы берется из *_GROUP_NAMES по этому номеру (0 - ниже нижней границы, вне призовых групп)
+OLDIES_BOUNDS = (6, 16, 35)
+OLDIES_GROUP_NAMES = ("< 6", "6-15", "16-34", "35+")
+TRIAL_BOUNDS = (5, 11, 16)
+TRIAL_GROUP_NAMES = ("< 5", "5-10", "11-15", "16+")
+
+# Порядок вывода групп: на листах - только призовые группы от старших к младшим,
+# в сводке - все группы (группа ниже порога последней)
+OLDIES_SHEET_ORDER = ("35+", "16-34", "6-15")
+OLDIES_SUMMARY_ORDER = ("6-15", "16-34", "35+", "< 6")
+TRIAL_SHEET_ORDER = ("16+", "11-15", "5-10")
+TRIAL_SUMMARY_ORDER = ("16+", "11-15", "5-10", "< 5")
+
+# Стили Excel создаем один раз и переиспользуем во всех ячейках
+GOLD_FILL = PatternFill(start_color="FFD700", end_color="FFD700", fill_type="solid")
+HEADER_FILL = PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
+BOLD = Font(bold=True)
+CENTER = Alignment(horizontal="center")
+GROUP_FONT = Font(bold=True, color="0066CC")
+
 
 class TeacherStats:
     """Статистика по преподавателю."""
@@ -44,12 +90,12 @@ class TeacherStats:
         # Форма 2304918 (возврат студентов)
         self.form_2304918_total = 0
         self.form_2304918_studying = 0
-        self.form_2304918_data = []  # Исходные данные для проверки
+        self.form_2304918_data = []  # Исходные данные для проверки: (task_id, филиал, учится)
         
         # Форма 792300 (конверсия trial)
         self.form_792300_total = 0
         self.form_792300_studying = 0
-        self.form_792300_data = []  # Исходные данные для проверки
+        self.form_792300_data = []  # Исходные данные для проверки: (task_id, филиал, учится)
     
     @property
     def return_percentage(self) -> float:
@@ -104,33 +150,101 @@ class BranchStats:
         return self.return_percentage + self.conversion_percentage
 
 
+def rank_by_total_percentage(items: List[Any]) -> List[Any]:
+    """Сортирует TeacherStats/BranchStats по убыванию итогового процента."""
+    return sorted(items, key=attrgetter("total_percentage"), reverse=True)
+
+
+@dataclass
+class FormConfig:
+    """Параметры анализа формы Pyrus."""
+    form_id: int
+    title: str  # Название для логов
+    teacher_field_id: int  # Поле с преподавателем
+    studying_field_id: int  # Поле "учится"
+    branch_field_id: int  # Поле с филиалом
+    status_field_id: int  # Поле со статусом PE
+    exclusion_key: str  # Ключ списка исключений: 'oldies' или 'trial'
+    stats_prefix: str  # Префикс счетчиков в TeacherStats/BranchStats
+    
+    @property
+    def total_attr(self) -> str:
+        """Счетчик всех задач формы в TeacherStats/BranchStats."""
+        return f"{self.stats_prefix}_total"
+    
+    @property
+    def studying_attr(self) -> str:
+        """Счетчик задач формы с отметкой "учится"."""
+        return f"{self.stats_prefix}_studying"
+    
+    @property
+    def data_attr(self) -> str:
+        """Список исходных строк формы в TeacherStats (детализация)."""
+        return f"{self.stats_prefix}_data"
+
+
+FORM_2304918 = FormConfig(
+    form_id=2304918,
+    title="старички",
+    teacher_field_id=8,
+    studying_field_id=64,  # Поле "УЧИТСЯ (заполняет СО)"
+    branch_field_id=5,
+    status_field_id=7,
+    exclusion_key="oldies",
+    stats_prefix="form_2304918"
+)
+
+FORM_792300 = FormConfig(
+    form_id=792300,
+    title="новый клиент",
+    teacher_field_id=142,
+    studying_field_id=187,
+    branch_field_id=226,
+    status_field_id=228,
+    exclusion_key="trial",
+    stats_prefix="form_792300"
+)
+
+
 class PyrusDataAnalyzer:
     """Анализатор данных из Pyrus для создания Excel отчета."""
     
-    def __init__(self):
+    # Допустимые статусы PE
+    VALID_PE_STATUSES = frozenset(("PE Start", "PE Future", "PE 5"))
+    
+    def __init__(self, keep_details: bool = False):
+        """
+        Args:
+            keep_details: Сохранять исходные строки задач в TeacherStats.form_*_data
+                (в отчет они не попадают, нужны только для ручной проверки расчетов)
+        """
         self.client = PyrusClient()
+        self.keep_details = keep_details
         self.teachers_stats: Dict[str, TeacherStats] = {}
         self.branches_stats: Dict[str, BranchStats] = {}
         
+        # Кэш решений по преподавателю: (имя, тип формы) -> статистика или None, если исключен
+        self._teacher_cache: Dict[Tuple[str, str], Optional[TeacherStats]] = {}
+        
         # Загружаем списки исключений преподавателей
         self.excluded_teachers = self._load_exclusions()
     
-    def _get_field_value(self, field_list: List[Dict[str, Any]], field_id: int) -> Optional[Any]:
-        """Ищет значение поля по id, рекурсивно обходя вложенные секции."""
+    def _flatten_fields(self, field_list: List[Dict[str, Any]], fields_map: Optional[Dict[int, Any]] = None) -> Dict[int, Any]:
+        """Собирает значения всех полей задачи в словарь {id: value} за один обход вложенных секций.
+        
+        Если id встречается несколько раз, побеждает первое найденное значение.
+        """
+        if fields_map is None:
+            fields_map = {}
         for f in field_list or []:
-            if f.get("id") == field_id:
-                return f.get("value")
             val = f.get("value")
+            fields_map.setdefault(f.get("id"), val)
             if isinstance(val, dict) and isinstance(val.get("fields"), list):
-                nested = self._get_field_value(val.get("fields") or [], field_id)
-                if nested is not None:
-                    return nested
-        return None
+                self._flatten_fields(val.get("fields") or [], fields_map)
+        return fields_map
     
-    def _extract_teacher_name(self, task_fields: List[Dict[str, Any]], field_id: int) -> str:
-        """Извлекает ФИО преподавателя из поля справочника."""
-        value = self._get_field_value(task_fields, field_id)
-        
+    def _extract_teacher_name(self, value: Any) -> str:
+        """Извлекает ФИО преподавателя из значения поля справочника."""
         if isinstance(value, dict):
             # Поддержка person-объекта: first_name/last_name
             first_name = value.get("first_name", "")
@@ -151,59 +265,83 @@ class PyrusDataAnalyzer:
         
         return "Неизвестный преподаватель"
     
-    def _load_exclusions(self) -> Dict[str, Set[str]]:
-        """Загружает списки исключений преподавателей из JSON файла."""
+    def _load_exclusions(self) -> Dict[str, Any]:
+        """Загружает списки исключений преподавателей из JSON файла.
+        
+        Списки хранятся в нижнем регистре ('oldies_lower', 'trial_lower'), чтобы не приводить
+        регистр на каждой задаче.
+        """
         exclusions_file = Path(__file__).parent / "teacher_exclusions.json"
         
         try:
-            with open(exclusions_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return {
-                    'oldies': set(data.get('oldies', [])),
-                    'trial': set(data.get('trial', []))
-                }
+            with open(exclusions_file, 'rb') as f:
+                data = json_loads(f.read())
+                oldies = set(data.get('oldies', []))
+                trial = set(data.get('trial', []))
         except (FileNotFoundError, json.JSONDecodeError) as e:
             print(f"⚠️ Не удалось загрузить исключения из {exclusions_file}: {e}")
             print("Продолжаем без фильтрации преподавателей.")
-            return {'oldies': set(), 'trial': set()}
+            oldies, trial = set(), set()
+        
+        oldies_lower = [name.lower() for name in oldies]
+        trial_lower = [name.lower() for name in trial]
+        
+        return {
+            'oldies_lower': oldies_lower,
+            'trial_lower': trial_lower
+        }
     
-    def _is_teacher_excluded(self, teacher_name: str, form_type: str) -> bool:
+    def _is_teacher_excluded(self, teacher_name_lower: str, form_type: str) -> bool:
         """Проверяет, исключен ли преподаватель из указанной формы.
         
         Args:
-            teacher_name: Имя преподавателя
+            teacher_name_lower: Имя преподавателя в нижнем регистре
             form_type: 'oldies' для формы 2304918, 'trial' для формы 792300
         """
-        excluded_set = self.excluded_teachers.get(form_type, set())
+        excluded_lower = self.excluded_teachers.get(f"{form_type}_lower", [])
         
-        # Проверяем точное совпадение
-        if teacher_name in excluded_set:
-            return True
+        # Частичное совпадение (фамилия входит в имя преподавателя)
+        # покрывает и точное совпадение
+        return any(excluded_name in teacher_name_lower for excluded_name in excluded_lower)
+    
+    def _get_teacher_stats(self, teacher_name: str, form_type: str) -> Optional[TeacherStats]:
+        """Возвращает статистику преподавателя или None, если он исключен из формы.
         
-        # Проверяем частичное совпадение (фамилия входит в имя преподавателя)
-        for excluded_name in excluded_set:
-            if excluded_name.lower() in teacher_name.lower():
-                return True
+        Решение кэшируется по (имя, тип формы), поэтому повторные задачи того же
+        преподавателя не проходят проверку исключений заново.
+        """
+        key = (teacher_name, form_type)
+        if key in self._teacher_cache:
+            return self._teacher_cache[key]
         
-        return False
+        if self._is_teacher_excluded(teacher_name.lower(), form_type):
+            teacher_stats = None
+        else:
+            # Инициализируем статистику преподавателя только для НЕ исключенных
+            teacher_stats = self.teachers_stats.get(teacher_name)
+            if teacher_stats is None:
+                teacher_stats = TeacherStats(teacher_name)
+                self.teachers_stats[teacher_name] = teacher_stats
+        
+        self._teacher_cache[key] = teacher_stats
+        return teacher_stats
     
-    def _normalize_branch_name(self, branch_name: str) -> str:
-        """Нормализует название филиала для объединения данных."""
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _normalize_branch_name(branch_name: str) -> str:
+        """Нормализует название филиала для объединения данных (результат кэшируется)."""
         branch_name = branch_name.lower().strip()
         
         # Объединяем филиалы Копейска под единым названием
-        if "коммунистический" in branch_name and "22" in branch_name:
-            return "Копейск"
-        if "славы" in branch_name and "30" in branch_name:
-            return "Копейск"
+        for parts, alias in BRANCH_ALIASES:
+            if all(part in branch_name for part in parts):
+                return alias
         
         # Возвращаем оригинальное название с заглавной буквы
         return branch_name.title()
     
-    def _extract_branch_name(self, task_fields: List[Dict[str, Any]], field_id: int) -> str:
-        """Извлекает название филиала из поля справочника."""
-        value = self._get_field_value(task_fields, field_id)
-        
+    def _extract_branch_name(self, value: Any) -> str:
+        """Извлекает название филиала из значения поля справочника."""
         if isinstance(value, dict):
             # Проверяем массив values - основной способ для справочника филиалов
             values = value.get("values")
@@ -230,50 +368,39 @@ class PyrusDataAnalyzer:
         
         return "Неизвестный филиал"
     
-    def _is_valid_pe_status(self, task_fields: List[Dict[str, Any]], field_id: int) -> bool:
-        """Проверяет, соответствует ли статус PE одному из допустимых: PE Start, PE Future, PE 5."""
-        value = self._get_field_value(task_fields, field_id)
+    def _is_valid_pe_status(self, value: Any) -> bool:
+        """Проверяет, соответствует ли значение статуса PE одному из допустимых: PE Start, PE Future, PE 5."""
+        if isinstance(value, str):
+            return value.strip() in self.VALID_PE_STATUSES
         
-        # Допустимые статусы PE
-        valid_statuses = {"PE Start", "PE Future", "PE 5"}
+        if not isinstance(value, dict):
+            return False
         
-        if isinstance(value, dict):
-            # Проверяем choice_names для справочника выбора
-            choice_names = value.get("choice_names")
-            if isinstance(choice_names, list) and len(choice_names) > 0:
-                status = choice_names[0]
-                if isinstance(status, str) and status.strip() in valid_statuses:
-                    return True
-            
-            # Проверяем массив values для справочника
-            values = value.get("values")
-            if isinstance(values, list) and len(values) > 0:
-                status = values[0]
-                if isinstance(status, str) and status.strip() in valid_statuses:
-                    return True
-            
-            # Проверяем rows если values не найден  
-            rows = value.get("rows")
-            if isinstance(rows, list) and len(rows) > 0 and isinstance(rows[0], list) and len(rows[0]) > 0:
-                status = rows[0][0]
-                if isinstance(status, str) and status.strip() in valid_statuses:
-                    return True
-            
-            # Для обычных справочников проверяем text, name, value
-            for key in ("text", "name", "value"):
-                status_val = value.get(key)
-                if isinstance(status_val, str) and status_val.strip() in valid_statuses:
+        # choice_names для справочника выбора, values для справочника - берем первое значение
+        for key in ("choice_names", "values"):
+            items = value.get(key)
+            if isinstance(items, list) and items:
+                status = items[0]
+                if isinstance(status, str) and status.strip() in self.VALID_PE_STATUSES:
                     return True
         
-        if isinstance(value, str):
-            return value.strip() in valid_statuses
+        # Проверяем rows если values не найден
+        rows = value.get("rows")
+        if isinstance(rows, list) and rows and isinstance(rows[0], list) and rows[0]:
+            status = rows[0][0]
+            if isinstance(status, str) and status.strip() in self.VALID_PE_STATUSES:
+                return True
+        
+        # Для обычных справочников проверяем text, name, value
+        for key in ("text", "name", "value"):
+            status_val = value.get(key)
+            if isinstance(status_val, str) and status_val.strip() in self.VALID_PE_STATUSES:
+                return True
         
         return False
     
-    def _is_studying(self, task_fields: List[Dict[str, Any]], field_id: int) -> bool:
-        """Проверяет, отмечена ли галочка 'учится' в указанном поле."""
-        value = self._get_field_value(task_fields, field_id)
-        
+    def _is_studying(self, value: Any) -> bool:
+        """Проверяет, отмечена ли галочка 'учится' в значении поля."""
         if value is None:
             return False
         
@@ -295,156 +422,86 @@ class PyrusDataAnalyzer:
     
     async def analyze_form_2304918(self) -> None:
         """Анализ формы 2304918 (возврат студентов)."""
-        print("Анализ формы 2304918 (старички)...")
-        
-        form_id = 2304918
-        excluded_count = 0  # Счетчик исключенных преподавателей
-        teacher_field_id = 8  # Поле с преподавателем
-        studying_field_id = 64  # Поле "УЧИТСЯ (заполняет СО)"
-        branch_field_id = 5  # Поле с филиалом
-        status_field_id = 7  # Поле со статусом PE
-        
-        task_count = 0
-        filtered_count = 0
-        async for task in self.client.iter_register_tasks(form_id, include_archived=False):
-            task_count += 1
-            if task_count % 100 == 0:
-                print(f"Обработано {task_count} задач формы 2304918...")
-            
-            task_fields = task.get("fields", [])
-            task_id = task.get("id")
-            
-            # Проверяем статус PE - фильтруем только PE Start, PE Future, PE 5
-            if not self._is_valid_pe_status(task_fields, status_field_id):
-                continue
-            
-            filtered_count += 1
-            
-            # Извлекаем преподавателя
-            teacher_name = self._extract_teacher_name(task_fields, teacher_field_id)
-            
-            # Извлекаем филиал
-            branch_name = self._extract_branch_name(task_fields, branch_field_id)
-            
-            
-            # Инициализируем статистику филиала если нужно (для всех форм)
-            if branch_name not in self.branches_stats:
-                self.branches_stats[branch_name] = BranchStats(branch_name)
-            
-            branch_stats = self.branches_stats[branch_name]
-            
-            # Проверяем отметку "учится"
-            is_studying = self._is_studying(task_fields, studying_field_id)
-            
-            # ВСЕГДА учитываем в статистике филиала (даже исключенных преподавателей)
-            branch_stats.form_2304918_total += 1
-            if is_studying:
-                branch_stats.form_2304918_studying += 1
-            
-            # Проверяем исключения для старичков (форма 2304918) - только для статистики преподавателей
-            if self._is_teacher_excluded(teacher_name, 'oldies'):
-                excluded_count += 1
-                continue  # Не добавляем в статистику преподавателей, но уже добавили в статистику филиала
-            
-            # Инициализируем статистику преподавателя только для НЕ исключенных
-            if teacher_name not in self.teachers_stats:
-                self.teachers_stats[teacher_name] = TeacherStats(teacher_name)
-            
-            teacher_stats = self.teachers_stats[teacher_name]
-            
-            # Увеличиваем счетчик преподавателя
-            teacher_stats.form_2304918_total += 1
-            if is_studying:
-                teacher_stats.form_2304918_studying += 1
-            
-            # Сохраняем данные для детализации
-            teacher_stats.form_2304918_data.append({
-                "task_id": task_id,
-                "teacher": teacher_name,
-                "branch": branch_name,
-                "is_studying": is_studying
-            })
-        
-        print(f"Завершен анализ формы 2304918. Обработано {task_count} задач, отфильтровано {filtered_count} с валидным статусом PE, исключено {excluded_count} преподавателей.")
+        await self._analyze_form(FORM_2304918)
     
     async def analyze_form_792300(self) -> None:
         """Анализ формы 792300 (конверсия trial)."""
-        print("Анализ формы 792300 (новый клиент)...")
+        await self._analyze_form(FORM_792300)
+    
+    async def _analyze_form(self, cfg: FormConfig) -> None:
+        """Общий анализ формы: фильтр PE, счетчики филиалов и преподавателей, данные для детализации."""
+        print(f"Анализ формы {cfg.form_id} ({cfg.title})...")
         
-        form_id = 792300
+        total_attr, studying_attr, data_attr = cfg.total_attr, cfg.studying_attr, cfg.data_attr
         excluded_count = 0  # Счетчик исключенных преподавателей
-        teacher_field_id = 142  # Поле с преподавателем
-        studying_field_id = 187  # Поле "учится"
-        branch_field_id = 226  # Поле с филиалом
-        status_field_id = 228  # Поле со статусом PE
         
         task_count = 0
         filtered_count = 0
-        async for task in self.client.iter_register_tasks(form_id, include_archived=False):
+        async for task in self.client.iter_register_tasks(cfg.form_id, include_archived=False):
             task_count += 1
             if task_count % 100 == 0:
-                print(f"Обработано {task_count} задач формы 792300...")
+                print(f"Обработано {task_count} задач формы {cfg.form_id}...")
             
-            task_fields = task.get("fields", [])
-            task_id = task.get("id")
+            # Один обход полей задачи вместо рекурсивного поиска для каждого поля
+            fields_map = self._flatten_fields(task.get("fields", []))
             
-            # Проверяем статус PE - фильтруем только PE Start, PE Future, PE 5
-            if not self._is_valid_pe_status(task_fields, status_field_id):
+            # СНАЧАЛА проверяем статус PE - фильтруем только PE Start, PE Future, PE 5.
+            # Остальные поля разбираем только у прошедших фильтр задач
+            if not self._is_valid_pe_status(fields_map.get(cfg.status_field_id)):
                 continue
             
             filtered_count += 1
             
             # Извлекаем преподавателя
-            teacher_name = self._extract_teacher_name(task_fields, teacher_field_id)
+            teacher_name = self._extract_teacher_name(fields_map.get(cfg.teacher_field_id))
             
             # Извлекаем филиал
-            branch_name = self._extract_branch_name(task_fields, branch_field_id)
+            branch_name = self._extract_branch_name(fields_map.get(cfg.branch_field_id))
             
+            # Проверяем отметку "учится"
+            is_studying = self._is_studying(fields_map.get(cfg.studying_field_id))
             
             # Инициализируем статистику филиала если нужно (для всех форм)
-            if branch_name not in self.branches_stats:
-                self.branches_stats[branch_name] = BranchStats(branch_name)
-            
-            branch_stats = self.branches_stats[branch_name]
-            
-            # Проверяем отметку "учится"
-            is_studying = self._is_studying(task_fields, studying_field_id)
+            branch_stats = self.branches_stats.get(branch_name)
+            if branch_stats is None:
+                branch_stats = self.branches_stats[branch_name] = BranchStats(branch_name)
             
             # ВСЕГДА учитываем в статистике филиала (даже исключенных преподавателей)
-            branch_stats.form_792300_total += 1
+            setattr(branch_stats, total_attr, getattr(branch_stats, total_attr) + 1)
             if is_studying:
-                branch_stats.form_792300_studying += 1
+                setattr(branch_stats, studying_attr, getattr(branch_stats, studying_attr) + 1)
             
-            # Проверяем исключения для trial (форма 792300) - только для статистики преподавателей
-            if self._is_teacher_excluded(teacher_name, 'trial'):
+            # Проверяем исключения для формы - только для статистики преподавателей
+            teacher_stats = self._get_teacher_stats(teacher_name, cfg.exclusion_key)
+            if teacher_stats is None:
                 excluded_count += 1
                 continue  # Не добавляем в статистику преподавателей, но уже добавили в статистику филиала
             
-            # Инициализируем статистику преподавателя только для НЕ исключенных
-            if teacher_name not in self.teachers_stats:
-                self.teachers_stats[teacher_name] = TeacherStats(teacher_name)
-            
-            teacher_stats = self.teachers_stats[teacher_name]
-            
             # Увеличиваем счетчик преподавателя
-            teacher_stats.form_792300_total += 1
+            setattr(teacher_stats, total_attr, getattr(teacher_stats, total_attr) + 1)
             if is_studying:
-                teacher_stats.form_792300_studying += 1
+                setattr(teacher_stats, studying_attr, getattr(teacher_stats, studying_attr) + 1)
             
-            # Сохраняем данные для детализации
-            teacher_stats.form_792300_data.append({
-                "task_id": task_id,
-                "teacher": teacher_name,
-                "branch": branch_name,
-                "is_studying": is_studying
-            })
-        
-        print(f"Завершен анализ формы 792300. Обработано {task_count} задач, отфильтровано {filtered_count} с валидным статусом PE, исключено {excluded_count} преподавателей.")
-    
-    def create_excel_reports(self, filename: str = "pyrus_teacher_report.xlsx") -> None:
-        """Создает Excel файл с 3 вкладками: Вывод старичков, Конверсия trial, Статистика по филиалам."""
+            # Сохраняем данные для детализации (только по запросу - отчет их не использует)
+            if self.keep_details:
+                getattr(teacher_stats, data_attr).append((task.get("id"), branch_name, is_studying))
+        
+        print(f"Завершен анализ формы {cfg.form_id}. Обработано {task_count} задач, отфильтровано {filtered_count} с валидным статусом PE, исключено {excluded_count} преподавателей.")
+    
+    def create_excel_reports(self, filename: str = "pyrus_teacher_report.xlsx", sorted_branches: Optional[List[BranchStats]] = None,
+                             teachers: Optional[List[TeacherStats]] = None) -> None:
+        """Создает Excel файл с 3 вкладками: Вывод старичков, Конверсия trial, Статистика по филиалам.
+        
+        Args:
+            filename: Путь к файлу отчета
+            sorted_branches: Филиалы, уже отсортированные по итоговому проценту (если None - сортируются здесь)
+            teachers: Список статистик преподавателей (если None - берется из teachers_stats)
+        """
         print(f"Создание Excel отчета: {filename}")
         
+        if teachers is None:
+            teachers = list(self.teachers_stats.values())
+        
         # Создаем один файл с тремя листами
         wb = Workbook()
         
@@ -453,16 +510,16 @@ class PyrusDataAnalyzer:
         
         # Вкладка 1: Вывод старичков (форма 2304918)
         print("Создание вкладки 'Вывод старичков'...")
-        self._create_oldies_sheet(wb)
+        self._create_oldies_sheet(wb, teachers)
         
         # Вкладка 2: Конверсия trial (форма 792300)
         print("Создание вкладки 'Конверсия trial'...")
-        self._create_trial_sheet(wb)
+        self._create_trial_sheet(wb, teachers)
         
         # Вкладка 3: Статистика по филиалам
         if self.branches_stats:
             print(f"Создание вкладки 'Статистика по филиалам': {len(self.branches_stats)} филиалов")
-            self._create_branch_summary_sheet(wb)
+            self._create_branch_summary_sheet(wb, sorted_branches)
         else:
             print("⚠️ Нет данных по филиалам для создания вкладки")
         
@@ -471,7 +528,7 @@ class PyrusDataAnalyzer:
         print(f"✅ Отчет сохранен: {filename}")
         print("Файл содержит 3 вкладки: Вывод старичков, Конверсия trial, Статистика по филиалам!")
     
-    def _create_oldies_sheet(self, wb: Workbook) -> None:
+    def _create_oldies_sheet(self, wb: Workbook, teachers: List[TeacherStats]) -> None:
         """Создает вкладку 'Вывод старичков' с группировкой по количеству студентов и призами."""
         ws = wb.create_sheet("Вывод старичков")
         
@@ -484,29 +541,22 @@ class PyrusDataAnalyzer:
             "🏆 Приз"
         ]
         
-        # Применяем заголовки
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True)
-            cell.fill = PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
-            cell.alignment = Alignment(horizontal="center")
+        # Применяем заголовки; col_max - максимальная длина значения в каждой колонке
+        ws.append(headers)
+        col_max = [0] * len(headers)
+        self._update_column_widths(col_max, headers)
+        for cell in ws[1]:
+            cell.font = BOLD
+            cell.fill = HEADER_FILL
+            cell.alignment = CENTER
         
         # Группируем преподавателей по количеству студентов (форма 2304918)
         # Порядок: от большего к меньшему
-        groups = {
-            "35+": [],
-            "16-34": [], 
-            "6-15": []
-        }
-        
-        for teacher_name, stats in self.teachers_stats.items():
-            student_count = stats.form_2304918_total
-            if 6 <= student_count <= 15:
-                groups["6-15"].append(stats)
-            elif 16 <= student_count <= 34:
-                groups["16-34"].append(stats)
-            elif student_count >= 35:
-                groups["35+"].append(stats)
+        buckets = [[] for _ in OLDIES_GROUP_NAMES]
+        for stats in teachers:
+            buckets[bisect_right(OLDIES_BOUNDS, stats.form_2304918_total)].append(stats)
+        by_name = dict(zip(OLDIES_GROUP_NAMES, buckets))
+        groups = {name: by_name[name] for name in OLDIES_SHEET_ORDER}
         
         # Определяем призы для каждой группы
         prize_configs = {
@@ -525,67 +575,54 @@ class PyrusDataAnalyzer:
             # Добавляем заголовок группы
             group_emojis = {"35+": "🥇", "16-34": "🥈", "6-15": "🥉"}
             emoji = group_emojis.get(group_name, "📋")
-            ws.cell(row=row, column=1, value=f"{emoji} Группа {group_name} студентов:")
-            ws.cell(row=row, column=1).font = Font(bold=True, color="0066CC")
+            group_title = f"{emoji} Группа {group_name} студентов:"
+            ws.cell(row=row, column=1, value=group_title)
+            self._update_column_widths(col_max, (group_title,))
+            ws.cell(row=row, column=1).font = GROUP_FONT
             row += 1
             
+            config = prize_configs[group_name]
+            
             # Сортируем по % возврата, при равенстве - по количеству клиентов
-            sorted_teachers = sorted(
-                teachers_list, 
-                key=lambda x: (x.return_percentage, x.form_2304918_total), 
-                reverse=True
+            sorted_teachers = self._rank_teachers(
+                teachers_list,
+                key=lambda x: (x.return_percentage, x.form_2304918_total),
+                winners_count=config["count"]
             )
             
-            # Определяем призы
-            config = prize_configs[group_name]
+            # Определяем призы: подписи для мест группы готовим один раз
+            prizes_for_group = [
+                PRIZE_LABELS[base_prize]
+                for base_prize in config.get("prizes", [config.get("prize")] * config["count"])
+            ]
             for i, stats in enumerate(sorted_teachers):
-                prize = ""
-                if i < config["count"]:
-                    if group_name == "35+" and "prizes" in config:
-                        base_prize = config["prizes"][i]
-                        if base_prize == "iPad":
-                            prize = "📱 iPad"
-                        elif base_prize == "HonorPad":
-                            prize = "📲 HonorPad"
-                    else:
-                        base_prize = config["prize"]
-                        if base_prize == "Подписка в Tg Premium":
-                            prize = "💎 Подписка в Tg Premium"
-                        elif base_prize == "HonorPad":
-                            prize = "📲 HonorPad"
+                prize = prizes_for_group[i] if i < config["count"] else ""
                 
-                ws.cell(row=row, column=1, value=stats.name)
-                ws.cell(row=row, column=2, value=stats.form_2304918_total)
-                ws.cell(row=row, column=3, value=stats.form_2304918_studying)
-                ws.cell(row=row, column=4, value=round(stats.return_percentage, 2))
-                ws.cell(row=row, column=5, value=prize)
+                # append пишет в строку, следующую за последней заполненной, - это и есть row
+                row_values = [
+                    stats.name,
+                    stats.form_2304918_total,
+                    stats.form_2304918_studying,
+                    round(stats.return_percentage, 2),
+                    prize
+                ]
+                ws.append(row_values)
+                self._update_column_widths(col_max, row_values)
                 
                 # Выделяем призеров
                 if prize:
-                    for col in range(1, 6):
-                        ws.cell(row=row, column=col).fill = PatternFill(
-                            start_color="FFD700", end_color="FFD700", fill_type="solid"
-                        )
+                    for cell in ws[row]:
+                        cell.fill = GOLD_FILL
                 
                 row += 1
             
             # Добавляем пустую строку между группами
             row += 1
         
-        # Автоширина колонок
-        for column in ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 30)
-            ws.column_dimensions[column_letter].width = adjusted_width
-    
-    def _create_trial_sheet(self, wb: Workbook) -> None:
+        # Автоширина колонок по длинам, собранным при записи
+        self._apply_column_widths(ws, col_max)
+    
+    def _create_trial_sheet(self, wb: Workbook, teachers: List[TeacherStats]) -> None:
         """Создает вкладку 'Конверсия trial' с группировкой по % конверсии и призами."""
         ws = wb.create_sheet("Конверсия trial")
         
@@ -598,29 +635,22 @@ class PyrusDataAnalyzer:
             "🏆 Приз"
         ]
         
-        # Применяем заголовки
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True)
-            cell.fill = PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
-            cell.alignment = Alignment(horizontal="center")
+        # Применяем заголовки; col_max - максимальная длина значения в каждой колонке
+        ws.append(headers)
+        col_max = [0] * len(headers)
+        self._update_column_widths(col_max, headers)
+        for cell in ws[1]:
+            cell.font = BOLD
+            cell.fill = HEADER_FILL
+            cell.alignment = CENTER
         
         # Группируем преподавателей по количеству БПЗ студентов (форма 792300)
         # Порядок: от большего к меньшему
-        groups = {
-            "16+": [],
-            "11-15": [],
-            "5-10": []
-        }
-        
-        for teacher_name, stats in self.teachers_stats.items():
-            bpz_count = stats.form_792300_total
-            if 5 <= bpz_count <= 10:
-                groups["5-10"].append(stats)
-            elif 11 <= bpz_count <= 15:
-                groups["11-15"].append(stats)
-            elif bpz_count >= 16:
-                groups["16+"].append(stats)
+        buckets = [[] for _ in TRIAL_GROUP_NAMES]
+        for stats in teachers:
+            buckets[bisect_right(TRIAL_BOUNDS, stats.form_792300_total)].append(stats)
+        by_name = dict(zip(TRIAL_GROUP_NAMES, buckets))
+        groups = {name: by_name[name] for name in TRIAL_SHEET_ORDER}
         
         # Определяем призы для каждой группы
         prize_configs = {
@@ -639,67 +669,77 @@ class PyrusDataAnalyzer:
             # Добавляем заголовок группы
             group_emojis = {"16+": "🥇", "11-15": "🥈", "5-10": "🥉"}
             emoji = group_emojis.get(group_name, "📋")
-            ws.cell(row=row, column=1, value=f"{emoji} Группа {group_name} БПЗ студентов:")
-            ws.cell(row=row, column=1).font = Font(bold=True, color="0066CC")
+            group_title = f"{emoji} Группа {group_name} БПЗ студентов:"
+            ws.cell(row=row, column=1, value=group_title)
+            self._update_column_widths(col_max, (group_title,))
+            ws.cell(row=row, column=1).font = GROUP_FONT
             row += 1
             
+            config = prize_configs[group_name]
+            
             # Сортируем по % конверсии, при равенстве - по количеству БПЗ студентов
-            sorted_teachers = sorted(
+            sorted_teachers = self._rank_teachers(
                 teachers_list,
                 key=lambda x: (x.conversion_percentage, x.form_792300_total),
-                reverse=True
+                winners_count=config["count"]
             )
             
-            # Определяем призы
-            config = prize_configs[group_name]
+            # Определяем призы: подписи для мест группы готовим один раз
+            prizes_for_group = [
+                PRIZE_LABELS[base_prize]
+                for base_prize in config.get("prizes", [config.get("prize")] * config["count"])
+            ]
             for i, stats in enumerate(sorted_teachers):
-                prize = ""
-                if i < config["count"]:
-                    if group_name == "16+" and "prizes" in config:
-                        base_prize = config["prizes"][i]
-                        if base_prize == "iPad":
-                            prize = "📱 iPad"
-                        elif base_prize == "HonorPad":
-                            prize = "📲 HonorPad"
-                    else:
-                        base_prize = config["prize"]
-                        if base_prize == "Подписка в Tg Premium":
-                            prize = "💎 Подписка в Tg Premium"
-                        elif base_prize == "HonorPad":
-                            prize = "📲 HonorPad"
+                prize = prizes_for_group[i] if i < config["count"] else ""
                 
-                ws.cell(row=row, column=1, value=stats.name)
-                ws.cell(row=row, column=2, value=stats.form_792300_total)
-                ws.cell(row=row, column=3, value=stats.form_792300_studying)
-                ws.cell(row=row, column=4, value=round(stats.conversion_percentage, 2))
-                ws.cell(row=row, column=5, value=prize)
+                # append пишет в строку, следующую за последней заполненной, - это и есть row
+                row_values = [
+                    stats.name,
+                    stats.form_792300_total,
+                    stats.form_792300_studying,
+                    round(stats.conversion_percentage, 2),
+                    prize
+                ]
+                ws.append(row_values)
+                self._update_column_widths(col_max, row_values)
                 
                 # Выделяем призеров
                 if prize:
-                    for col in range(1, 6):
-                        ws.cell(row=row, column=col).fill = PatternFill(
-                            start_color="FFD700", end_color="FFD700", fill_type="solid"
-                        )
+                    for cell in ws[row]:
+                        cell.fill = GOLD_FILL
                 
                 row += 1
             
             # Добавляем пустую строку между группами
             row += 1
         
-        # Автоширина колонок
-        for column in ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 30)
-            ws.column_dimensions[column_letter].width = adjusted_width
-    
-    def _create_branch_summary_sheet(self, wb: Workbook) -> None:
+        # Автоширина колонок по длинам, собранным при записи
+        self._apply_column_widths(ws, col_max)
+    
+    def _update_column_widths(self, col_max: List[int], values) -> None:
+        """Обновляет максимальные длины значений по колонкам для записанной строки."""
+        for i, value in enumerate(values):
+            if value is not None:
+                length = len(str(value))
+                if length > col_max[i]:
+                    col_max[i] = length
+    
+    def _apply_column_widths(self, ws, col_max: List[int], max_width: int = 30) -> None:
+        """Выставляет ширину колонок по собранным длинам (не шире max_width)."""
+        for i, length in enumerate(col_max, 1):
+            ws.column_dimensions[get_column_letter(i)].width = min(length + 2, max_width)
+    
+    def _rank_teachers(self, teachers_list: List[TeacherStats], key, winners_count: int) -> List[TeacherStats]:
+        """Сортирует группу по убыванию: призеров выбирает через heapq.nlargest, остальных досортировывает.
+        
+        Порядок совпадает с sorted(..., reverse=True), так как nlargest сохраняет порядок равных элементов.
+        """
+        winners = heapq.nlargest(winners_count, teachers_list, key=key)
+        winner_ids = {id(stats) for stats in winners}
+        rest = [stats for stats in teachers_list if id(stats) not in winner_ids]
+        return winners + sorted(rest, key=key, reverse=True)
+    
+    def _create_branch_summary_sheet(self, wb: Workbook, sorted_branches: Optional[List[BranchStats]] = None) -> None:
         """Создает лист со статистикой по филиалам."""
         ws = wb.create_sheet("Статистика по филиалам")
         
@@ -716,19 +756,18 @@ class PyrusDataAnalyzer:
             "🎁 Приз"
         ]
         
-        # Применяем заголовки
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True)
-            cell.fill = PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
-            cell.alignment = Alignment(horizontal="center")
-        
-        # Сортируем филиалы по итоговому проценту (по убыванию)
-        sorted_branches = sorted(
-            self.branches_stats.values(),
-            key=lambda x: x.total_percentage,
-            reverse=True
-        )
+        # Применяем заголовки; col_max - максимальная длина значения в каждой колонке
+        ws.append(headers)
+        col_max = [0] * len(headers)
+        self._update_column_widths(col_max, headers)
+        for cell in ws[1]:
+            cell.font = BOLD
+            cell.fill = HEADER_FILL
+            cell.alignment = CENTER
+        
+        # Сортируем филиалы по итоговому проценту (по убыванию), если порядок не передан
+        if sorted_branches is None:
+            sorted_branches = rank_by_total_percentage(list(self.branches_stats.values()))
         
         # Определяем призы для топ-5 филиалов
         branch_prizes = [
@@ -747,37 +786,29 @@ class PyrusDataAnalyzer:
             if i < len(branch_prizes):
                 prize = branch_prizes[i]
             
-            ws.cell(row=row, column=1, value=branch_stats.name)
-            ws.cell(row=row, column=2, value=branch_stats.form_2304918_total)
-            ws.cell(row=row, column=3, value=branch_stats.form_2304918_studying)
-            ws.cell(row=row, column=4, value=round(branch_stats.return_percentage, 2))
-            ws.cell(row=row, column=5, value=branch_stats.form_792300_total)
-            ws.cell(row=row, column=6, value=branch_stats.form_792300_studying)
-            ws.cell(row=row, column=7, value=round(branch_stats.conversion_percentage, 2))
-            ws.cell(row=row, column=8, value=round(branch_stats.total_percentage, 2))
-            ws.cell(row=row, column=9, value=prize)
+            row_values = (
+                branch_stats.name,
+                branch_stats.form_2304918_total,
+                branch_stats.form_2304918_studying,
+                round(branch_stats.return_percentage, 2),
+                branch_stats.form_792300_total,
+                branch_stats.form_792300_studying,
+                round(branch_stats.conversion_percentage, 2),
+                round(branch_stats.total_percentage, 2),
+                prize
+            )
+            ws.append(row_values)
+            self._update_column_widths(col_max, row_values)
             
-            # Выделяем призеров ярким желтым
+            # Выделяем призеров ярким желтым (стиль общий для всех ячеек)
             if prize:
-                for col in range(1, 10):
-                    ws.cell(row=row, column=col).fill = PatternFill(
-                        start_color="FFD700", end_color="FFD700", fill_type="solid"
-                    )
+                for cell in ws[row]:
+                    cell.fill = GOLD_FILL
             
             row += 1
         
-        # Автоширина колонок
-        for column in ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 30)  # Уменьшили максимальную ширину с 50 до 30
-            ws.column_dimensions[column_letter].width = adjusted_width
+        # Автоширина колонок по длинам, собранным при записи
+        self._apply_column_widths(ws, col_max)
     
     
     async def run_analysis(self) -> None:
@@ -787,7 +818,9 @@ class PyrusDataAnalyzer:
         reports_dir.mkdir(exist_ok=True)
         
         print("Начинаем анализ данных из Pyrus...")
-        print(f"Время начала: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        # Время начала запуска - и для вывода, и для имени файла отчета
+        started_at = datetime.now()
+        print(f"Время начала: {started_at.strftime('%Y-%m-%d %H:%M:%S')}")
         
         # Анализируем обе формы
         await self.analyze_form_2304918()
@@ -795,52 +828,44 @@ class PyrusDataAnalyzer:
         
         # Выводим краткую статистику
         print("\n=== КРАТКАЯ СТАТИСТИКА ===")
-        total_teachers = len(self.teachers_stats)
+        # Списки статистик собираем один раз и переиспользуем ниже и в Excel отчете
+        teachers = list(self.teachers_stats.values())
+        branches = list(self.branches_stats.values())
+        total_teachers = len(teachers)
         print(f"Всего преподавателей: {total_teachers}")
         
-        # Статистика по группам старичков
-        oldies_groups = {"6-15": 0, "16-34": 0, "35+": 0, "< 6": 0}
-        for stats in self.teachers_stats.values():
-            student_count = stats.form_2304918_total
-            if 6 <= student_count <= 15:
-                oldies_groups["6-15"] += 1
-            elif 16 <= student_count <= 34:
-                oldies_groups["16-34"] += 1
-            elif student_count >= 35:
-                oldies_groups["35+"] += 1
-            else:
-                oldies_groups["< 6"] += 1
+        # Статистика по группам старичков и БПЗ: счетчики выкладываем в numpy-массивы,
+        # номер группы находим через searchsorted (как bisect_right), количество - через bincount.
+        # Индексы групп: 0 - ниже нижней границы, далее по возрастанию границ
+        student_counts = np.fromiter(
+            (stats.form_2304918_total for stats in teachers),
+            dtype=np.int32, count=total_teachers
+        )
+        bpz_counts = np.fromiter(
+            (stats.form_792300_total for stats in teachers),
+            dtype=np.int32, count=total_teachers
+        )
+        og = np.bincount(np.searchsorted(OLDIES_BOUNDS, student_counts, side="right"), minlength=len(OLDIES_GROUP_NAMES))
+        tg = np.bincount(np.searchsorted(TRIAL_BOUNDS, bpz_counts, side="right"), minlength=len(TRIAL_GROUP_NAMES))
+        
+        oldies_counts = dict(zip(OLDIES_GROUP_NAMES, og.tolist()))
+        trial_counts = dict(zip(TRIAL_GROUP_NAMES, tg.tolist()))
+        oldies_groups = {name: oldies_counts[name] for name in OLDIES_SUMMARY_ORDER}
+        trial_groups = {name: trial_counts[name] for name in TRIAL_SUMMARY_ORDER}
         
         print("\nГруппы по старичкам:")
         for group, count in oldies_groups.items():
             print(f"  {group} студентов: {count} преподавателей")
         
-        # Статистика по группам БПЗ
-        trial_groups = {"16+": 0, "11-15": 0, "5-10": 0, "< 5": 0}
-        for stats in self.teachers_stats.values():
-            bpz_count = stats.form_792300_total
-            if 5 <= bpz_count <= 10:
-                trial_groups["5-10"] += 1
-            elif 11 <= bpz_count <= 15:
-                trial_groups["11-15"] += 1
-            elif bpz_count >= 16:
-                trial_groups["16+"] += 1
-            else:
-                trial_groups["< 5"] += 1
-        
         print("\nГруппы по БПЗ студентам:")
         for group, count in trial_groups.items():
             print(f"  {group} БПЗ студентов: {count} преподавателей")
         
-        # Статистика по филиалам
-        if self.branches_stats:
-            print(f"\nВсего филиалов: {len(self.branches_stats)}")
+        # Статистика по филиалам (сортировка общая для консоли и Excel)
+        sorted_branches = rank_by_total_percentage(branches)
+        if branches:
+            print(f"\nВсего филиалов: {len(branches)}")
             print("\nТоп-5 филиалов по итоговому проценту:")
-            sorted_branches = sorted(
-                self.branches_stats.values(),
-                key=lambda x: x.total_percentage,
-                reverse=True
-            )
             for i, branch_stats in enumerate(sorted_branches[:5], 1):
                 print(f"{i}. {branch_stats.name}: {branch_stats.total_percentage:.2f}% "
                       f"(возврат: {branch_stats.return_percentage:.2f}%, "
@@ -849,11 +874,7 @@ class PyrusDataAnalyzer:
         
         if total_teachers > 0:
             print("\nТоп-5 преподавателей по итоговому проценту:")
-            sorted_teachers = sorted(
-                self.teachers_stats.values(),
-                key=lambda x: x.total_percentage,
-                reverse=True
-            )
+            sorted_teachers = rank_by_total_percentage(teachers)
             for i, stats in enumerate(sorted_teachers[:5], 1):
                 print(f"{i}. {stats.name}: {stats.total_percentage:.2f}% "
                       f"(возврат: {stats.return_percentage:.2f}%, "
@@ -861,9 +882,9 @@ class PyrusDataAnalyzer:
                       f"[{stats.form_2304918_total} форм 2304918]")
         
         # Создаем Excel отчет с категориями по вкладкам
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        timestamp = started_at.strftime("%Y%m%d_%H%M%S")
         filename = f"reports/pyrus_teacher_report_{timestamp}.xlsx"
-        self.create_excel_reports(filename)
+        self.create_excel_reports(filename, sorted_branches=sorted_branches, teachers=teachers)
         
         print(f"\nАнализ завершен: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 